@@ -9,98 +9,277 @@ Survey Pre‑processing Toolkit  📊 (Streamlit, minimal)
 * No auto/manual renaming; relies on existing `(TEXT)` columns for value labels.
 """
 from __future__ import annotations
-import io, zipfile, re
+import hashlib, io, math, zipfile
+from collections import Counter
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import streamlit as st
 
+# Copy-on-Write: copies share data until a column is actually written to,
+# so the working copy of the upload costs nothing up front
+pd.set_option('mode.copy_on_write', True)
+
 # ---------- Helper ------------------
 
+SKIP_LABEL = '스킵(해당 없음)'
+# st.cache_data only hashes a 10k-row sample of frames with 50k+ rows, so cached steps take
+# frames as unhashed `_df` arguments keyed by `key`: the upload digest plus every step
+# (and its options) applied so far. Exports are keyed the same way. Entries are whole
+# frames or files, so keep only a few.
+_MAX_FRAMES = 4
+# pandas' default na_values; Arrow's own list lacks the last two
+_CSV_NA_VALUES = pa_csv.ConvertOptions().null_values + ['<NA>', 'None']
+
 def detect_pairs(cols):
-    return {c[:-6]: c for c in cols if str(c).endswith('(TEXT)') and str(c)[:-6] in cols}
+    names = set(cols)
+    return {s[:-6]: c for c in cols if (s := str(c)).endswith('(TEXT)') and s[:-6] in names}
 
 def detect_multiresp(code_cols):
     groups = {}
     for c in code_cols:
-        m = re.match(r'(.*?)_', str(c))
-        if m:
-            groups.setdefault(m.group(1), []).append(c)
+        s = c if isinstance(c, str) else str(c)
+        i = s.find('_')  # prefix up to the first underscore; an empty prefix still groups,
+        if i >= 0 and s.find('\n', 0, i) < 0:  # one spanning a line break does not
+            groups.setdefault(s[:i], []).append(c)
     return {g: v for g, v in groups.items() if len(v) >= 2}
 
 
-def handle_missing(df: pd.DataFrame, id_var: str):
-    mresp_flat = {c for cols in detect_multiresp(list(detect_pairs(df.columns).keys())).values() for c in cols}
-    for col in mresp_flat:
-        df[col] = df[col].notna().astype(int)
-    for col in df.columns:
-        if col in mresp_flat or col == id_var:
-            continue
-        if pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_integer_dtype(df[col]):
-            if df[col].nunique(dropna=True) <= 20:
-                df[col] = df[col].fillna('스킵(해당 없음)')
+@lru_cache(maxsize=8)
+def _schema(cols: tuple):
+    """(TEXT) pairs and flattened multi-response columns for a column set (shared, don't mutate)."""
+    pairs = detect_pairs(cols)
+    mresp_flat = frozenset(c for grp in detect_multiresp(list(pairs)).values() for c in grp)
+    return pairs, mresp_flat
+
+
+def upload_digest(f) -> str:
+    """Content hash of an uploaded file, read through its buffer without copying the bytes."""
+    return hashlib.sha256(f.getbuffer()).hexdigest()
+
+
+def _arrow_csv(buf, names: list) -> pd.DataFrame | None:
+    """Parse a CSV body with the multi-threaded Arrow reader under pandas' column names.
+
+    Returns None for files Arrow would read differently from pd.read_csv: rows missing
+    trailing fields, column types that change after the first block, integers beyond int64.
+    """
+    keys = [f'c{i}' for i in range(len(names))]  # unique stand-ins, so single columns can be retyped
+    # the header is skipped as one CSV record, and quoted cells may span lines (free-text answers)
+    opts = dict(read_options=pa_csv.ReadOptions(column_names=keys, skip_rows_after_names=1),
+                parse_options=pa_csv.ParseOptions(newlines_in_values=True))
+    # pandas' NA strings and booleans (Arrow alone would also take 1/0 as bool)
+    conv = dict(strings_can_be_null=True, null_values=_CSV_NA_VALUES,
+                true_values=['True', 'TRUE', 'true'], false_values=['False', 'FALSE', 'false'])
+    try:
+        # pandas leaves dates/times as text: the first block's schema says which columns to keep as string
+        buf.seek(0)
+        first = pa_csv.open_csv(buf, convert_options=pa_csv.ConvertOptions(**conv), **opts).schema
+        text = {f.name: pa.string() for f in first if pa.types.is_temporal(f.type)}
+        buf.seek(0)
+        tbl = pa_csv.read_csv(buf, convert_options=pa_csv.ConvertOptions(column_types=text, **conv), **opts)
+    except pa.ArrowInvalid:  # e.g. a row without its trailing empty fields; pandas pads those with NaN
+        return None
+    for f, g in zip(first, tbl.schema):
+        # dates/times first seen in a later block, or a numeric column that turns to text there
+        # (pandas keeps the parsed numbers and the strings side by side in one object column)
+        if pa.types.is_temporal(g.type) or (pa.types.is_string(g.type) and f.name not in text
+                                            and not (pa.types.is_string(f.type) or pa.types.is_null(f.type))):
+            return None
+    tbl = tbl.rename_columns(names)
+    # all-empty columns come back as Arrow null -> object; pandas reads them as float NaN
+    # (a header-only file stays object, as in pandas)
+    empty = [f.name for f in tbl.schema if pa.types.is_null(f.type)]
+    df = tbl.to_pandas().astype(dict.fromkeys(empty, 'float64' if tbl.num_rows else 'object'))
+    # Arrow turns integers beyond int64 (long IDs) into doubles; pandas keeps them as uint64 or text
+    if any((np.abs(df[c].to_numpy()) >= 2.0 ** 63).any() for c in df.select_dtypes('float').columns):
+        return None
     return df
 
 
-def add_weights(df: pd.DataFrame, pop_df: pd.DataFrame, strata, pop_col='pop_share'):
-    df['__key__'] = list(zip(*[df[c] for c in strata]))
-    pop_df['__key__'] = list(zip(*[pop_df[c] for c in strata]))
-    samp = df['__key__'].value_counts() / len(df)
-    samp.name = 'sample_share'
-    df = df.merge(samp.to_frame(), left_on='__key__', right_index=True)
-    df = df.merge(pop_df[['__key__', pop_col]], on='__key__', how='left')
-    df[pop_col] = df[pop_col].fillna(0)
-    df['weight'] = df[pop_col] / df['sample_share']
-    return df.drop(columns=['__key__', 'sample_share', pop_col])
+@st.cache_data(show_spinner='Parsing upload…', max_entries=_MAX_FRAMES)
+def read_upload(digest: str, _buf, suffix: str, xl_header: int = 0) -> pd.DataFrame:
+    """Parse an uploaded CSV/Excel file once; `digest` keys the cache, `_buf` is only read on a miss."""
+    _buf.seek(0)
+    if suffix in {'.xlsx', '.xls'}:
+        return pd.read_excel(_buf, header=xl_header, engine='calamine')
+    # header via the C parser (pandas BOM / duplicate-name handling), body via Arrow where it agrees
+    names = list(pd.read_csv(_buf, nrows=0).columns)
+    df = _arrow_csv(_buf, names)
+    if df is None:
+        _buf.seek(0)
+        df = pd.read_csv(_buf)
+    return df
+
+
+def to_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """Store low-cardinality object columns as `category` (int codes + small dictionary)."""
+    obj_cols = df.select_dtypes('object').columns
+    nun = df[obj_cols].nunique(dropna=True)
+    cat_cols = nun.index[nun <= min(50, 0.05 * len(df))]
+    df[cat_cols] = df[cat_cols].astype('category')
+    return df
+
 
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES)
+def handle_missing(key: tuple, _df: pd.DataFrame, id_var: str):
+    df = _df
+    _, mresp_flat = _schema(tuple(df.columns))
+    mr_cols = [c for c in df.columns if c in mresp_flat]
+    # 1 where an option was picked, 0 where it is NA; the fresh bool mask is viewed as int8
+    df[mr_cols] = pd.notna(df[mr_cols].to_numpy()).view(np.int8)
+    cand = df.select_dtypes(include=['object', 'integer', 'category']).columns.difference(
+        [id_var, *mr_cols], sort=False)
+    # only columns with something to fill need the cardinality check
+    has_na = df[cand].isna().any()
+    nun = df[has_na.index[has_na]].nunique(dropna=True)
+    low = nun.index[nun <= 20]
+    for c in low:  # categoricals only accept the skip label once it is a category
+        if isinstance(df[c].dtype, pd.CategoricalDtype) and SKIP_LABEL not in df[c].cat.categories:
+            df[c] = df[c].cat.add_categories(SKIP_LABEL)
+    df.fillna(dict.fromkeys(low, SKIP_LABEL), inplace=True)
+    df[low] = df[low].astype('category')  # ≤ 21 distinct values each
+    return df
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES)
+def add_weights(key: tuple, _df: pd.DataFrame, pop_digest: str, _pop_df: pd.DataFrame, strata, pop_col='pop_share'):
+    df, pop_df = _df, _pop_df
+    if len(strata) == 1:  # group ids straight from the one column
+        gid, uniq = pd.factorize(df[strata[0]], use_na_sentinel=False)  # NaN keeps its own group
+        # look up only the distinct strata, then broadcast back to rows via the group ids
+        pos = pd.MultiIndex.from_frame(pop_df[strata]).get_indexer(pd.MultiIndex.from_arrays([uniq]))[gid]
+    else:
+        keys = pd.MultiIndex.from_frame(df[strata])  # strata factorized once, reused for both lookups
+        dims = [n + 1 for n in keys.levshape]  # codes shifted by 1 so NaN (-1) gets its own slot
+        if math.prod(dims) < 2 ** 63:  # one int64 stratum id per row, then a hash pass without sort
+            gid, _ = pd.factorize(np.ravel_multi_index([c.astype(np.intp) + 1 for c in keys.codes], dims))
+        else:  # too many level combinations for one int64 id
+            gid = df.groupby(strata, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+        pos = pd.MultiIndex.from_frame(pop_df[strata]).get_indexer(keys)
+    samp_share = np.bincount(gid)[gid] / len(df)
+    pop_share = pd.api.extensions.take(pop_df[pop_col].to_numpy(dtype='float64'), pos, allow_fill=True)
+    # take() returns a new array, so strata missing from the population are zeroed in place
+    pop_share[np.isnan(pop_share)] = 0
+    df['weight'] = pop_share / samp_share
+    return df
 
-def label_encode(df: pd.DataFrame):
-    pairs = detect_pairs(df.columns)
-    mresp_flat = {c for cols in detect_multiresp(list(pairs.keys())).values() for c in cols}
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES)
+def label_encode(key: tuple, _df: pd.DataFrame):
+    df = _df
+    pairs, mresp_flat = _schema(tuple(df.columns))
     used = set(df.columns)
+    last_sfx = Counter()  # last _N handed out per base label; collisions resume from there
+    rename_map, codes, texts = {}, [], []
     for code_col, text_col in pairs.items():
         if code_col in mresp_flat:
-            lbl = df[text_col].dropna().astype(str).unique()
-            lbl = lbl[0] if len(lbl) else code_col
-            base, i = lbl, 1
+            # new name: the first non-null text label
+            has = df[text_col].notna().to_numpy()
+            lbl = str(df[text_col].iat[has.argmax()]) if has.any() else code_col
+            base = lbl
             while lbl in used:
-                lbl = f"{base}_{i}"; i += 1
-            df.rename(columns={code_col: lbl}, inplace=True)
+                last_sfx[base] += 1
+                lbl = f"{base}_{last_sfx[base]}"
+            rename_map[code_col] = lbl
             used.add(lbl)
         else:
-            df[code_col] = df[text_col]
-        df.drop(columns=text_col, inplace=True)
+            codes.append(code_col)
+            texts.append(text_col)
+    # the frame assignment pairs columns positionally and keeps each text column's dtype
+    if codes:
+        df[codes] = df[texts]
+    df.rename(columns=rename_map, inplace=True)
+    df.drop(columns=list(pairs.values()), inplace=True)
     return df
 
 
-def build_codebook(orig_df: pd.DataFrame) -> pd.DataFrame:
-    rows = []
-    pairs = detect_pairs(orig_df.columns)
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES, ttl='1h')
+def build_codebook(key: tuple, _orig_df: pd.DataFrame) -> pd.DataFrame:
+    orig_df = _orig_df
+    pairs, mresp_flat = _schema(tuple(orig_df.columns))
+    if not pairs:  # no (TEXT) columns -> no multi-response groups either
+        return pd.DataFrame()
+    var, code, lab = [], [], []
     for code_col, text_col in pairs.items():
-        subset = orig_df[[code_col, text_col]].dropna().drop_duplicates()
-        if subset.empty:
+        subset = orig_df[[code_col, text_col]].dropna().drop_duplicates().to_numpy()
+        if not len(subset):
             continue
-        for code, label in subset.values:
-            rows.append({'variable': code_col, 'code': code, 'label': label})
+        var.extend([code_col] * len(subset))
+        code.extend(subset[:, 0])
+        lab.extend(subset[:, 1])
     # Add binary MR columns without TEXT
-    mresp_flat = {c for cols in detect_multiresp(list(pairs.keys())).values() for c in cols}
     for col in mresp_flat:
         if col not in pairs:
-            rows.append({'variable': col, 'code': 1, 'label': 'Selected'})
-    return pd.DataFrame(rows)
+            var.append(col); code.append(1); lab.append('Selected')
+    if not var:
+        return pd.DataFrame()
+    return pd.DataFrame({'variable': var, 'code': code, 'label': lab})
 
 
-def tidy_zip(df: pd.DataFrame, id_var: str) -> bytes:
-    pairs = detect_pairs(df.columns)
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES, ttl='1h')
+def tidy_zip(key: tuple, _df: pd.DataFrame, id_var: str) -> bytes:
+    df = _df
+    pairs, _ = _schema(tuple(df.columns))
     buf = io.BytesIO()
-    with zipfile.ZipFile(buf, 'w') as zf:
+    # level-1 deflate: CSV text shrinks several-fold for little CPU
+    with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
         if pairs:
-            frames = []
-            for code_col, text_col in pairs.items():
-                tid = df[[id_var, code_col, text_col]].dropna(subset=[code_col]).rename(
-                    columns={code_col:'code_value', text_col:'label'})
-                tid['variable'] = code_col
-                frames.append(tid[[id_var,'variable','code_value','label']])
-            zf.writestr('all_tidy.csv', pd.concat(frames).to_csv(index=False, encoding='utf-8-sig'))
+            # codes and texts melt in the same column-major order, so labels line up row for row
+            tid = df.melt(id_vars=[id_var], value_vars=list(pairs), var_name='variable', value_name='code_value')
+            tid['label'] = df[list(pairs.values())].melt(value_name='label')['label'].to_numpy()
+            tid = tid.dropna(subset=['code_value'])
+            # written straight into the zip member
+            with zf.open('all_tidy.csv', 'w', force_zip64=True) as fh:
+                fh.write(b'\xef\xbb\xbf')  # UTF-8 BOM so Excel reads Korean labels
+                tid.to_csv(fh, index=False, encoding='utf-8')
+    return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES, ttl='1h')
+def excel_bytes(key: tuple, _df: pd.DataFrame, _codebook_df: pd.DataFrame) -> bytes:
+    df, codebook_df = _df, _codebook_df
+    bio = io.BytesIO()
+    # constant_memory is not usable here: pandas emits cells column by column
+    xl_opts = {'strings_to_urls': False, 'strings_to_formulas': False}
+    with pd.ExcelWriter(bio, engine='xlsxwriter', engine_kwargs={'options': xl_opts}) as xl:
+        df.to_excel(xl, index=False, sheet_name='data')
+        if not codebook_df.empty:
+            codebook_df.to_excel(xl, index=False, sheet_name='codebook')
+    return bio.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES, ttl='1h')
+def csv_bytes(key: tuple, _df: pd.DataFrame) -> bytes:
+    df = _df
+    bio = io.BytesIO()
+    df.to_csv(bio, index=False, encoding='utf-8-sig')
+    return bio.getvalue()
+
+
+def _arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    # Arrow wants str column names and one type per column; mixed object columns go out as text
+    obj_cols = [c for c, dt in df.dtypes.items() if pd.api.types.is_object_dtype(dt)
+                or (isinstance(dt, pd.CategoricalDtype) and dt.categories.inferred_type.startswith('mixed'))]
+    return df.astype(dict.fromkeys(obj_cols, 'string')).rename(columns=str)
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES, ttl='1h')
+def parquet_bytes(key: tuple, _df: pd.DataFrame) -> bytes:
+    df = _df
+    buf = io.BytesIO()
+    _arrow_safe(df).to_parquet(buf, engine='pyarrow', compression='zstd', index=False)
+    return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=_MAX_FRAMES, ttl='1h')
+def feather_bytes(key: tuple, _df: pd.DataFrame) -> bytes:
+    df = _df
+    buf = io.BytesIO()
+    _arrow_safe(df).reset_index(drop=True).to_feather(buf, compression='zstd')
     return buf.getvalue()
 
 # ---------- Streamlit UI ----------
@@ -124,6 +303,8 @@ else:
 miss_ck = st.sidebar.checkbox("Missing-value handling", value=True)
 lab_ck  = st.sidebar.checkbox("Label encoding")
 tidy_ck = st.sidebar.checkbox("Tidy export (zip)")
+out_fmt = st.sidebar.radio("Download format", ["Excel", "Parquet", "Feather", "CSV"],
+                           help="Parquet/Feather/CSV are much faster to write than Excel for large files")
 run     = st.sidebar.button("🚀 Run")
 
 if not run or raw is None:
@@ -132,8 +313,11 @@ if not run or raw is None:
 
 # Load raw + keep a copy for codebook
 suf = Path(raw.name).suffix.lower()
-orig_df = pd.read_excel(raw, header=1) if suf in {'.xlsx', '.xls'} else pd.read_csv(raw)
-proc_df = orig_df.copy()
+raw_digest = upload_digest(raw)
+orig_df = to_categories(read_upload(raw_digest, raw, suf, xl_header=1))
+proc_df = orig_df.copy(deep=False)  # CoW: only the columns a step rewrites get copied
+orig_key = (raw_digest,)
+proc_key = orig_key  # cache key of proc_df: the upload plus each step applied so far
 
 # Weights
 if use_w:
@@ -142,33 +326,45 @@ if use_w:
     strata = [s.strip() for s in strata_cols.split(',') if s.strip()]
     if not strata:
         st.error("Enter strata columns and rerun"); st.stop()
-    pop_df = pd.read_csv(pop_f) if Path(pop_f.name).suffix.lower()=='.csv' else pd.read_excel(pop_f)
-    proc_df = add_weights(proc_df, pop_df, strata, pop_col=pop_col)
+    pop_digest = upload_digest(pop_f)
+    pop_df = read_upload(pop_digest, pop_f, Path(pop_f.name).suffix.lower())
+    if pop_df[strata].duplicated().any():
+        st.error("Population file has more than one row per stratum; keep one and rerun"); st.stop()
+    proc_df = add_weights(proc_key, proc_df, pop_digest, pop_df, strata, pop_col=pop_col)
+    proc_key += ('weights', pop_digest, tuple(strata), pop_col)
     st.success("Weights added ✅")
 
 # Missing
 if miss_ck:
-    proc_df = handle_missing(proc_df, id_var)
+    proc_df = handle_missing(proc_key, proc_df, id_var)
+    proc_key += ('missing', id_var)
     st.success("Missing handling done ✅")
 
 # Label
 if lab_ck:
-    proc_df = label_encode(proc_df)
+    proc_df = label_encode(proc_key, proc_df)
+    proc_key += ('label',)
     st.success("Label encoding done ✅")
 
 # Codebook sheet
-codebook_df = build_codebook(orig_df)
+codebook_df = build_codebook(orig_key, orig_df)
 
+# Downloads use on_click="ignore": a click would otherwise rerun the script, which resets the
+# Run button and drops the other download before the user gets to it
 # Tidy zip
 if tidy_ck:
-    zbytes = tidy_zip(orig_df, id_var)
-    st.download_button("Download tidy zip", zbytes, file_name="tidy_outputs.zip", mime="application/zip")
+    zbytes = tidy_zip(orig_key, orig_df, id_var)
+    st.download_button("Download tidy zip", zbytes, file_name="tidy_outputs.zip", mime="application/zip", on_click="ignore")
 
-# Final Excel with codebook
-bio = io.BytesIO()
-with pd.ExcelWriter(bio, engine='openpyxl') as xl:
-    proc_df.to_excel(xl, index=False, sheet_name='data')
-    if not codebook_df.empty:
-        codebook_df.to_excel(xl, index=False, sheet_name='codebook')
-
-st.download_button("Download processed Excel (+ codebook)", bio.getvalue(), file_name="processed.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+# Final output: Excel carries the codebook as a sheet, fast formats ship it as codebook.csv in a zip
+if out_fmt == 'Excel':
+    st.download_button("Download processed Excel (+ codebook)", excel_bytes(proc_key, proc_df, codebook_df), file_name="processed.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", on_click="ignore")
+else:
+    ext = out_fmt.lower()
+    writer = {'Parquet': parquet_bytes, 'Feather': feather_bytes, 'CSV': csv_bytes}[out_fmt]
+    bio = io.BytesIO()
+    with zipfile.ZipFile(bio, 'w') as zf:
+        zf.writestr(f"processed.{ext}", writer(proc_key, proc_df))
+        if not codebook_df.empty:
+            zf.writestr("codebook.csv", csv_bytes(orig_key + ('codebook',), codebook_df))
+    st.download_button(f"Download processed {out_fmt} (+ codebook)", bio.getvalue(), file_name=f"processed_{ext}.zip", mime="application/zip", on_click="ignore")